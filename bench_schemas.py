@@ -0,0 +1,83 @@
+"""Сравнение стоимости разбора запроса /best_options и ответов upstream: прежние ручные проверки и схемы msgspec.
+
+    python bench_schemas.py [--number 20000]
+"""
+import argparse
+import asyncio
+import json
+import timeit
+
+import main
+
+REQUEST_BODY = json.dumps({
+    "city": "Y2l0eV9oYXNo",
+    "skus": [{"sku": f"sku-{i}", "count_desired": 1} for i in range(5)],
+    "address": {"lat": 43.24, "lng": 76.9},
+}).encode()
+
+PRICE_BODY = json.dumps({
+    "status": "success",
+    "result": {"delivery": [{"price": 900, "eta": 30}, {"price": 1200, "eta": 20}]},
+}).encode()
+
+
+def legacy_parse_request(body):
+    """Прежний разбор: request.json() и проверки в цикле."""
+    request_data = json.loads(body)
+    encoded_city = request_data.get("city")
+    sku_data = request_data.get("skus", [])
+    user_lat = request_data.get("address", {}).get("lat")
+    user_lon = request_data.get("address", {}).get("lng")
+
+    if not encoded_city or not sku_data or user_lat is None or user_lon is None:
+        return None
+    if not isinstance(user_lat, (int, float)) or not isinstance(user_lon, (int, float)):
+        return None
+    for item in sku_data:
+        if not isinstance(item.get("sku"), str) or not isinstance(item.get("count_desired"), int):
+            return None
+
+    payload = [{"sku": item["sku"], "count_desired": item["count_desired"]} for item in sku_data]
+    return encoded_city, payload, user_lat, user_lon
+
+
+def legacy_parse_search(body):
+    data = json.loads(body)
+    return data if isinstance(data, dict) and "result" in data else None
+
+
+def legacy_parse_price(body):
+    data = json.loads(body)
+    return data if data.get("status") == "success" else None
+
+
+def schema_parse_search(body):
+    return main.decode_upstream(main.SearchResponse, body)
+
+
+def schema_parse_price(body):
+    return main.decode_upstream(main.PriceResponse, body)
+
+
+def bench(name, func, body, number):
+    seconds = min(timeit.repeat(lambda: func(body), number=number, repeat=3))
+    print(f"{name:<28} {seconds / number * 1e6:8.2f} us")
+
+
+def run():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--number", type=int, default=20000)
+    args = parser.parse_args()
+
+    search_body = asyncio.run(main.search_medicines()).body
+
+    bench("request: legacy", legacy_parse_request, REQUEST_BODY, args.number)
+    bench("request: schema", main.parse_best_options_request, REQUEST_BODY, args.number)
+    bench("URL_SEARCH: legacy", legacy_parse_search, search_body, args.number)
+    bench("URL_SEARCH: schema", schema_parse_search, search_body, args.number)
+    bench("URL_PRICE: legacy", legacy_parse_price, PRICE_BODY, args.number)
+    bench("URL_PRICE: schema", schema_parse_price, PRICE_BODY, args.number)
+
+
+if __name__ == "__main__":
+    run()
@@ -1,27 +1,289 @@
+import asyncio
+import atexit
+import collections
+import contextvars
+import heapq
+import hmac
+import itertools
 import json
 import os
+import queue
+import resource
+import sys
+import threading
+import time
+from contextlib import contextmanager
 from datetime import datetime, timedelta
+from email.utils import parsedate_to_datetime
 import pytz
 from fastapi import FastAPI, Request
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 import httpx
 import logging
 import math
+from logging.handlers import QueueHandler, QueueListener
+from typing import List, Optional, Union
+import msgspec
+from typing_extensions import Annotated
 from fastapi.middleware.cors import CORSMiddleware
 from dotenv import load_dotenv
 
 load_dotenv()
 
-logging.basicConfig(level=logging.INFO)  
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+# Не больше LOG_RATE_LIMIT одинаковых (по шаблону) сообщений за LOG_RATE_INTERVAL секунд
+LOG_RATE_LIMIT = int(os.getenv("LOG_RATE_LIMIT", "20"))
+LOG_RATE_INTERVAL = float(os.getenv("LOG_RATE_INTERVAL", "10"))
+
+
+class JsonFormatter(logging.Formatter):
+    """Одна JSON-строка на запись; сообщение собирается только здесь, в потоке QueueListener."""
+
+    def format(self, record):
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, pytz.UTC).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        if getattr(record, "suppressed", 0):
+            entry["suppressed"] = record.suppressed
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class RateLimitFilter(logging.Filter):
+    """Ограничивает повторяющиеся сообщения ниже WARNING (например, по каждой аптеке в best_option).
+
+    Отброшенные записи считаются, и их число попадает в поле suppressed
+    первой записи того же шаблона в следующем интервале. Если шаблон больше не встречается,
+    число отброшенных записей выводится отдельной записью при очистке завершившихся интервалов.
+    """
+
+    def __init__(self, limit, interval):
+        super().__init__()
+        self.limit = limit
+        self.interval = interval
+        self.windows = {}  # (logger, шаблон) -> [начало интервала, записей, отброшено]
+        self.flushed_at = time.time()
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+
+        key = (record.name, record.msg)
+        window = self.windows.get(key)
+        if window is None or record.created - window[0] >= self.interval:
+            if window is not None and window[2]:
+                record.suppressed = window[2]
+            window = self.windows[key] = [record.created, 0, 0]
+
+        window[1] += 1
+        if record.created - self.flushed_at >= self.interval:
+            self.flush(record.created)
+        if window[1] > self.limit:
+            window[2] += 1
+            return False
+        return True
+
+    def flush(self, now=float("inf")):
+        """Удаляет завершившиеся интервалы и сообщает о записях, отброшенных в них."""
+        self.flushed_at = now
+        for key, window in list(self.windows.items()):
+            if now - window[0] < self.interval:
+                continue
+            if self.windows.pop(key, None) is not None and window[2]:
+                name, template = key
+                logging.getLogger(name).info(
+                    "Suppressed %s repeated log records: %s", window[2], template, extra={"suppressed": window[2]}
+                )
+
+
+class LazyQueueHandler(QueueHandler):
+    """Кладет запись в очередь без форматирования; время постановки учитывается в профиле запроса."""
+
+    def prepare(self, record):
+        # Неизменяемые аргументы форматируются позже в потоке записи. Остальные (dict аптек, ответы upstream)
+        # цикл событий может изменить, пока запись ждет в очереди, поэтому сообщение собирается сразу.
+        # (logging передает единственный аргумент-dict как record.args, он тоже изменяемый)
+        args = record.args or ()
+        if isinstance(args, dict) or not all(isinstance(arg, (str, int, float, bool, type(None))) for arg in args):
+            record.msg = record.getMessage()
+            record.args = None
+        return record
+
+    def handle(self, record):
+        started = time.perf_counter()
+        try:
+            return super().handle(record)
+        finally:
+            profile_add_stage("logging", time.perf_counter() - started)
+            profile_count("log_records", 1)
+
+
+# Запись логов выполняет фоновый поток, цикл событий только ставит записи в очередь
+log_queue = queue.SimpleQueue()
+log_handler = LazyQueueHandler(log_queue)
+log_rate_limit = RateLimitFilter(LOG_RATE_LIMIT, LOG_RATE_INTERVAL)
+log_handler.addFilter(log_rate_limit)
+log_output = logging.StreamHandler()
+log_output.setFormatter(JsonFormatter())
+log_listener = QueueListener(log_queue, log_output)
+
+logging.basicConfig(level=LOG_LEVEL, handlers=[log_handler])
+log_listener.start()
+atexit.register(log_listener.stop)
+atexit.register(log_rate_limit.flush)  # Выполняется раньше остановки потока записи
 logger = logging.getLogger(__name__)
 app = FastAPI()
 
 URL_SEARCH = os.getenv("URL_SEARCH")
 URL_PRICE = os.getenv("URL_PRICE")
 
+# Кэши ответов URL_SEARCH и URL_PRICE (время жизни в секундах, 0 - кэш отключен)
+SEARCH_CACHE_TTL = float(os.getenv("SEARCH_CACHE_TTL", "60"))
+QUOTE_CACHE_TTL = float(os.getenv("QUOTE_CACHE_TTL", "60"))
+CACHE_MAX_ENTRIES = int(os.getenv("CACHE_MAX_ENTRIES", "5000"))
+
+# Прогрев кэшей популярными корзинами при старте и по расписанию
+WARMUP_TOP_N = int(os.getenv("WARMUP_TOP_N", "20"))
+WARMUP_INTERVAL = float(os.getenv("WARMUP_INTERVAL", "60"))
+WARMUP_TIMEOUT = float(os.getenv("WARMUP_TIMEOUT", "30"))
+WARMUP_RATE = float(os.getenv("WARMUP_RATE", "2"))  # корзин в секунду, 0 - без пауз
+WARMUP_KEYS_FILE = os.getenv("WARMUP_KEYS_FILE", "warmup_keys.json")
+# Прогреваются только корзины, которые запрашивались за последние WARMUP_KEY_MAX_AGE секунд
+# (после перераспределения городов между воркерами чужие корзины перестают прогреваться)
+WARMUP_KEY_MAX_AGE = float(os.getenv("WARMUP_KEY_MAX_AGE", "86400"))
+WARMUP_MAX_KEYS = 10000
+
+# Номер воркера при шардировании по городам (router.py)
+SHARD_ID = os.getenv("SHARD_ID")
+
+# Контроль нагрузки /best_options: адаптивный лимит одновременных запросов и ограниченная очередь
+ADMISSION_LATENCY_SLO = float(os.getenv("ADMISSION_LATENCY_SLO", "3"))  # секунды обработки запроса
+ADMISSION_INITIAL_CONCURRENCY = int(os.getenv("ADMISSION_INITIAL_CONCURRENCY", "20"))
+ADMISSION_MIN_CONCURRENCY = int(os.getenv("ADMISSION_MIN_CONCURRENCY", "2"))
+ADMISSION_MAX_CONCURRENCY = int(os.getenv("ADMISSION_MAX_CONCURRENCY", "200"))
+ADMISSION_MAX_QUEUE = int(os.getenv("ADMISSION_MAX_QUEUE", "50"))
+ADMISSION_QUEUE_TIMEOUT = float(os.getenv("ADMISSION_QUEUE_TIMEOUT", "1"))
+# Сколько секунд после истечения можно отдавать итоговый ответ из кэша при перегрузке
+ADMISSION_STALE_MAX_AGE = float(os.getenv("ADMISSION_STALE_MAX_AGE", "600"))
+# Приоритеты клиентов по заголовку X-Client-Id: "mobile=0,web=1,batch=2" (меньше - важнее)
+CLIENT_PRIORITIES = {
+    client.strip(): int(priority)
+    for client, priority in (item.split("=") for item in os.getenv("CLIENT_PRIORITIES", "").split(",") if "=" in item)
+}
+DEFAULT_CLIENT_PRIORITY = int(os.getenv("DEFAULT_CLIENT_PRIORITY", "1"))
+
+# Общие для процесса лимиты исходящих запросов (запросов в секунду и размер всплеска, 0 - без ограничения)
+URL_SEARCH_RATE = float(os.getenv("URL_SEARCH_RATE", "20"))
+URL_SEARCH_BURST = int(os.getenv("URL_SEARCH_BURST", "20"))
+URL_PRICE_RATE = float(os.getenv("URL_PRICE_RATE", "50"))
+URL_PRICE_BURST = int(os.getenv("URL_PRICE_BURST", "50"))
+# Повторы после 429 и пауза, если upstream не прислал Retry-After
+UPSTREAM_429_RETRIES = int(os.getenv("UPSTREAM_429_RETRIES", "1"))
+UPSTREAM_DEFAULT_RETRY_AFTER = float(os.getenv("UPSTREAM_DEFAULT_RETRY_AFTER", "1"))
+# Пауза после 429 не дольше UPSTREAM_MAX_RETRY_AFTER секунд; повтор - только если пауза не дольше UPSTREAM_RETRY_BUDGET
+UPSTREAM_MAX_RETRY_AFTER = float(os.getenv("UPSTREAM_MAX_RETRY_AFTER", "30"))
+UPSTREAM_RETRY_BUDGET = float(os.getenv("UPSTREAM_RETRY_BUDGET", "2"))
+# Сколько запрос к upstream может ждать токен, после этого он считается отклоненным (как 429)
+UPSTREAM_QUEUE_TIMEOUT = float(os.getenv("UPSTREAM_QUEUE_TIMEOUT", "5"))
+
+search_cache = {}
+quote_cache = {}
+# Итоговые ответы /best_options; живут до ближайшей смены статуса аптек-кандидатов
+result_cache = {}
+
+caches = {"search": search_cache, "quote": quote_cache, "result": result_cache}
+cache_counters = collections.Counter()  # (id кэша, "hits" / "misses") -> число обращений
+
+# Статистика запросов: (city, skus) -> {"count", "lat", "lng"}
+request_keys = {}
+warmup_state = {"ready": False, "task": None}
+
+# Запись запросов /best_options вместе с ответами URL_SEARCH и URL_PRICE для replay.py
+RECORD_FILE = os.getenv("RECORD_FILE")
+recording_lock = threading.Lock()
+
+# Данные текущего запроса /best_options (None вне запроса, например при прогреве)
+request_context = contextvars.ContextVar("request_context", default=None)
+
+# Профилирование: разбивка по этапам для запросов с заголовком X-Profile-Token (или всех при PROFILE_ALL=1)
+PROFILE_TOKEN = os.getenv("PROFILE_TOKEN")
+PROFILE_ALL = os.getenv("PROFILE_ALL", "0") == "1"
+PROFILE_MAX_SECONDS = 60
+
 # Define the payload
 payload = []
 
+Number = Union[int, float]
+
+
+# Схемы тела запроса /best_options (msgspec проверяет типы и собирает объекты за один проход)
+class SkuItem(msgspec.Struct):
+    sku: str
+    count_desired: int
+
+
+class UserAddress(msgspec.Struct):
+    lat: Number
+    lng: Number
+
+
+class BestOptionsRequest(msgspec.Struct):
+    city: Annotated[str, msgspec.Meta(min_length=1)]  # Encoded city hash
+    skus: Annotated[List[SkuItem], msgspec.Meta(min_length=1)]
+    address: UserAddress
+
+
+# Схемы ответов URL_SEARCH и URL_PRICE: только поля, которые читает сервис
+class PharmacySource(msgspec.Struct):
+    # Поля, которые дальше читаются через source["..."], обязательны (но могут быть null)
+    lat: Optional[Number]
+    lon: Optional[Number]
+    closes_at: Optional[str]
+    opens_at: Optional[str]
+    code: Optional[str] = None
+    opening_hours: str = ""
+
+
+class PharmacyProduct(msgspec.Struct):
+    sku: str
+    quantity: Number
+    quantity_desired: Number
+
+
+class SearchPharmacy(msgspec.Struct):
+    source: PharmacySource
+    products: List[PharmacyProduct]
+    total_sum: Number
+
+
+class SearchResponse(msgspec.Struct):
+    result: List[SearchPharmacy]
+
+
+class DeliveryOption(msgspec.Struct):
+    price: Number
+    eta: Number
+
+
+class DeliveryResult(msgspec.Struct):
+    delivery: List[DeliveryOption]
+
+
+class PriceResponse(msgspec.Struct):
+    status: str
+    result: Optional[DeliveryResult] = None
+
+    def __post_init__(self):
+        if self.status == "success" and self.result is None:
+            raise ValueError("result is required when status is success")
+
+
+request_decoder = msgspec.json.Decoder(BestOptionsRequest)
+
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -34,106 +296,343 @@ app.add_middleware(
 async def main_process(request: Request):
 
     try:
+        context = {}
+        request_context.set(context)
+        profile = start_profile(context) if PROFILE_ALL or profiling_allowed(request) else None
+
         # Receive the front end data (city hash, sku's, user address)
-        request_data = await request.json()
-        encoded_city = request_data.get("city")  # Encoded city hash
-        sku_data = request_data.get("skus", [])  # List of SKU items
-        address = request_data.get("address", {})  # User address
+        with profile_stage("parse"):
+            parsed = parse_best_options_request(await request.body())
+        if isinstance(parsed, JSONResponse):
+            return parsed
+
+        priority = CLIENT_PRIORITIES.get(request.headers.get("x-client-id"), DEFAULT_CLIENT_PRIORITY)
+
+        # Потоковый режим: сначала предварительный ответ, затем обновления по мере прихода котировок
+        if request.query_params.get("stream", "").lower() in ("1", "true") or \
+                "application/x-ndjson" in request.headers.get("accept", ""):
+            return StreamingResponse(stream_best_options(*parsed, priority), media_type="application/x-ndjson")
+
+        recording = start_recording(context)
+        result = await process_best_options(*parsed, priority)
+        if recording is not None:
+            await save_recording(await request.json(), recording, result)
+        if profile is not None:
+            return attach_profile(result, profile)
+
+        return result
+
+    except Exception as e:
+        logger.error("Unexpected error: %s", e)
+        return JSONResponse(content={"error": "An unexpected error occurred"}, status_code=500)
+
+
+
+async def process_best_options(encoded_city, payload, user_lat, user_lon, priority=DEFAULT_CLIENT_PRIORITY):
+    record_request_key(encoded_city, payload)
+
+    # При записи запросов кэш ответов не используется, чтобы сохранить ответы upstream
+    result_key = (encoded_city, json.dumps(payload, sort_keys=True), user_lat, user_lon)
+    cached_result = cache_get(result_cache, result_key) if not RECORD_FILE else None
+    if cached_result is not None:
+        profile_count("result_cache_hit", 1)
+        return cached_result
+
+    # При перегрузке запрос сразу получает ответ из устаревшего кэша или 503
+    if not await admission.acquire(priority):
+        return shed_response(result_key)
+
+    started = time.perf_counter()
+    try:
+        return await compute_best_options(encoded_city, payload, user_lat, user_lon, result_key)
+    finally:
+        admission.release(time.perf_counter() - started)
+
+
+async def compute_best_options(encoded_city, payload, user_lat, user_lon, result_key):
+    all_delivery_options = await collect_delivery_options(encoded_city, payload, user_lat, user_lon)
+    if isinstance(all_delivery_options, JSONResponse):
+        return all_delivery_options  # Возвращаем JSONResponse сразу, если это ошибка
+
+    with profile_stage("best_option", cpu=True):
+        result = await best_option(all_delivery_options)
+    save_response_to_file(result, file_name='data6_final_result.json')
+
+    if not isinstance(result, JSONResponse):
+        cache_set(result_cache, result_key, result, result_ttl(all_delivery_options))
+
+    return result
+
+
+def parse_best_options_request(body):
+    """Разбирает тело запроса и возвращает (encoded_city, payload, user_lat, user_lon) или JSONResponse с ошибкой."""
+    try:
+        request_data = request_decoder.decode(body)
+    except msgspec.ValidationError:
+        return request_error_response(json.loads(body))
+    except msgspec.DecodeError:
+        return JSONResponse(content={"error": "Invalid JSON format"}, status_code=400)
+
+    # Build the payload
+    payload = [{"sku": item.sku, "count_desired": item.count_desired} for item in request_data.skus]
+
+    return request_data.city, payload, request_data.address.lat, request_data.address.lng
+
 
+def request_error_response(request_data):
+    """Определяет текст ошибки для запроса, не прошедшего схему (прежний порядок проверок)."""
+    address = request_data.get("address") if isinstance(request_data, dict) else None
+    if not isinstance(address, dict):
+        return JSONResponse(content={"error": "City, SKU data, and user coordinates are required"}, status_code=400)
 
-        #Save the latitude and longitude of user
-        user_lat = request_data.get("address", {}).get("lat")
-        user_lon = request_data.get("address", {}).get("lng")
+    encoded_city = request_data.get("city")  # Encoded city hash
+    sku_data = request_data.get("skus", [])  # List of SKU items
+    user_lat = address.get("lat")
+    user_lon = address.get("lng")
 
-        # Validate the incoming data
-        if not encoded_city or not sku_data or user_lat is None or user_lon is None:
-            return JSONResponse(content={"error": "City, SKU data, and user coordinates are required"}, status_code=400)
+    if not isinstance(encoded_city, str) or not encoded_city or not sku_data or user_lat is None or user_lon is None:
+        return JSONResponse(content={"error": "City, SKU data, and user coordinates are required"}, status_code=400)
 
-        if not isinstance(user_lat, (int, float)) or not isinstance(user_lon, (int, float)):
+    for value in (user_lat, user_lon):
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
             return JSONResponse(content={"error": "Invalid data type for user coordinates"}, status_code=400)
 
-        for item in sku_data:
-            if not isinstance(item.get("sku"), str) or not isinstance(item.get("count_desired"), int):
-                return JSONResponse(content={"error": "Invalid SKU format or count type"}, status_code=400)
+    return JSONResponse(content={"error": "Invalid SKU format or count type"}, status_code=400)
 
-        # Build the payload
-        payload = [{"sku": item["sku"], "count_desired": item["count_desired"]} for item in sku_data]
 
-        # Perform the search for medicines in pharmacies
-        pharmacies = await find_medicines_in_pharmacies(encoded_city, payload)
+def decode_upstream(schema, content):
+    """Декодирует и проверяет ответ upstream по схеме; некорректные данные отсекаются до обработки (None)."""
+    try:
+        data = msgspec.json.decode(content)
+        msgspec.convert(data, schema)
+    except msgspec.DecodeError as e:
+        logger.error("Invalid %s from upstream: %s", schema.__name__, e)
+        return None
+    return data
 
-        if not pharmacies.get("result"):
-            logger.error("No pharmacies found with the provided SKU data")
-            return JSONResponse(content={"error": "No pharmacies found with the provided SKU data in URL_SEARCH"}, status_code=404)
-        save_response_to_file(pharmacies, file_name='data1_found_all.json')
 
-        #Save only pharmacies with all sku's in stock
-        filtered_pharmacies = await filter_pharmacies(pharmacies)
-        if isinstance(filtered_pharmacies, JSONResponse):
-            return filtered_pharmacies  # Возвращаем JSONResponse сразу, если это ошибка
-        save_response_to_file(filtered_pharmacies, file_name='data2_filtered_pharmacies.json')
-
-        # Get several pharmacies with cheapest SKU's
-        initial_cheapest_pharmacies = await get_top_cheapest_pharmacies(filtered_pharmacies)
-        save_response_to_file(initial_cheapest_pharmacies, file_name='data4_top_cheapest_pharmacies.json')
-
-        # Get 2 closest Pharmacies
-        initial_closest_pharmacies = await get_top_closest_pharmacies(filtered_pharmacies, user_lat, user_lon)
-        save_response_to_file(initial_closest_pharmacies, file_name='data4_top_closest_pharmacies.json')
-
-        # Убедимся, что среди выбранных аптек есть круглосуточные
-        updated_cheapest_pharmacies, updated_closest_pharmacies = await ensure_24h_pharmacies(
-            filtered_pharmacies["filtered_pharmacies"],
-            initial_cheapest_pharmacies,
-            initial_closest_pharmacies,
-            user_lat,
-            user_lon,
-        )
-        save_response_to_file(updated_cheapest_pharmacies, file_name='data4.1_updated_top_cheapest_pharmacies.json')
-        save_response_to_file(updated_closest_pharmacies, file_name='data4_2_updated_top_closest_pharmacies.json')
 
-        #Compare Check delivery price for 2 closest pharmacies and 3 cheapest pharmacies
+async def collect_delivery_options(encoded_city, payload, user_lat, user_lon):
+    """Поиск аптек, отбор кандидатов и получение вариантов доставки для них."""
+
+    candidates = await select_candidate_pharmacies(encoded_city, payload, user_lat, user_lon)
+    if isinstance(candidates, JSONResponse):
+        return candidates
+    _, updated_closest_pharmacies, updated_cheapest_pharmacies = candidates
+
+    #Compare Check delivery price for 2 closest pharmacies and 3 cheapest pharmacies
+    with profile_stage("quotes"):
         delivery_options1 = await get_delivery_options(updated_closest_pharmacies, user_lat, user_lon)
-        if isinstance(delivery_options1, JSONResponse):
-            return delivery_options1  # Возвращаем JSONResponse сразу, если это ошибка
-        save_response_to_file(delivery_options1, file_name='data5_delivery_options_closest.json')
+    if isinstance(delivery_options1, JSONResponse):
+        return delivery_options1  # Возвращаем JSONResponse сразу, если это ошибка
+    save_response_to_file(delivery_options1, file_name='data5_delivery_options_closest.json')
 
+    with profile_stage("quotes"):
         delivery_options2 = await get_delivery_options(updated_cheapest_pharmacies, user_lat, user_lon)
-        if isinstance(delivery_options2, JSONResponse):
-            return delivery_options2  # Возвращаем JSONResponse сразу, если это ошибка
-        save_response_to_file(delivery_options2, file_name='data5_delivery_options_cheapest.json')
+    if isinstance(delivery_options2, JSONResponse):
+        return delivery_options2  # Возвращаем JSONResponse сразу, если это ошибка
+    save_response_to_file(delivery_options2, file_name='data5_delivery_options_cheapest.json')
+
+    all_delivery_options = delivery_options1 + delivery_options2
+    profile_count("quotes", len(all_delivery_options))
+    save_response_to_file(all_delivery_options, file_name='data5_all_delivery_options.json')
+
+    return all_delivery_options
+
+
+async def select_candidate_pharmacies(encoded_city, payload, user_lat, user_lon):
+    """Поиск аптек и отбор кандидатов: (отфильтрованные, ближайшие, самые дешевые) или JSONResponse."""
+
+    # Perform the search for medicines in pharmacies
+    with profile_stage("search"):
+        pharmacies = await find_medicines_in_pharmacies(encoded_city, payload)
 
-        all_delivery_options = delivery_options1 + delivery_options2
-        save_response_to_file(all_delivery_options, file_name='data5_all_delivery_options.json')
+    if isinstance(pharmacies, JSONResponse):
+        return pharmacies
+    if not pharmacies.get("result"):
+        logger.error("No pharmacies found with the provided SKU data")
+        return JSONResponse(content={"error": "No pharmacies found with the provided SKU data in URL_SEARCH"}, status_code=404)
+    save_response_to_file(pharmacies, file_name='data1_found_all.json')
+    profile_count("pharmacies", len(pharmacies["result"]))
 
+    #Save only pharmacies with all sku's in stock
+    with profile_stage("filter"):
+        filtered_pharmacies = await filter_pharmacies(pharmacies)
+    if isinstance(filtered_pharmacies, JSONResponse):
+        return filtered_pharmacies  # Возвращаем JSONResponse сразу, если это ошибка
+    save_response_to_file(filtered_pharmacies, file_name='data2_filtered_pharmacies.json')
+    profile_count("filtered_pharmacies", len(filtered_pharmacies["filtered_pharmacies"]))
+
+    select_started = time.perf_counter()
+
+    # Get several pharmacies with cheapest SKU's
+    initial_cheapest_pharmacies = await get_top_cheapest_pharmacies(filtered_pharmacies)
+    save_response_to_file(initial_cheapest_pharmacies, file_name='data4_top_cheapest_pharmacies.json')
+
+    # Get 2 closest Pharmacies
+    initial_closest_pharmacies = await get_top_closest_pharmacies(filtered_pharmacies, user_lat, user_lon)
+    save_response_to_file(initial_closest_pharmacies, file_name='data4_top_closest_pharmacies.json')
+
+    # Убедимся, что среди выбранных аптек есть круглосуточные
+    updated_cheapest_pharmacies, updated_closest_pharmacies = await ensure_24h_pharmacies(
+        filtered_pharmacies["filtered_pharmacies"],
+        initial_cheapest_pharmacies,
+        initial_closest_pharmacies,
+        user_lat,
+        user_lon,
+    )
+    save_response_to_file(updated_cheapest_pharmacies, file_name='data4.1_updated_top_cheapest_pharmacies.json')
+    save_response_to_file(updated_closest_pharmacies, file_name='data4_2_updated_top_closest_pharmacies.json')
+    profile_add_stage("select", time.perf_counter() - select_started)
+    profile_count("candidates", len(updated_closest_pharmacies["list_pharmacies"]) + len(updated_cheapest_pharmacies["list_pharmacies"]))
+
+    return filtered_pharmacies, updated_closest_pharmacies, updated_cheapest_pharmacies
+
+
+async def stream_best_options(encoded_city, payload, user_lat, user_lon, priority=DEFAULT_CLIENT_PRIORITY):
+    """Потоковый /best_options (NDJSON): предварительный самый дешевый вариант сразу после фильтрации,
+    обновления по мере прихода котировок доставки и итоговый результат best_option."""
+
+    record_request_key(encoded_city, payload)
+
+    result_key = (encoded_city, json.dumps(payload, sort_keys=True), user_lat, user_lon)
+    cached_result = cache_get(result_cache, result_key)
+    if cached_result is not None:
+        yield ndjson_event("final", result=cached_result)
+        return
+
+    if not await admission.acquire(priority):
+        stale_result = cache_get_stale(result_cache, result_key, ADMISSION_STALE_MAX_AGE)
+        if stale_result is not None:
+            yield ndjson_event("final", result=stale_result, degraded=True)
+        else:
+            yield ndjson_event("error", status=503, error="Service is overloaded", retry_after=admission.retry_after())
+        return
+
+    started = time.perf_counter()
+    tasks = []
+    try:
+        candidates = await select_candidate_pharmacies(encoded_city, payload, user_lat, user_lon)
+        if isinstance(candidates, JSONResponse):
+            yield ndjson_error(candidates)
+            return
+        filtered_pharmacies, closest_pharmacies, cheapest_pharmacies = candidates
+
+        cheapest = min(filtered_pharmacies["filtered_pharmacies"], key=lambda x: x["total_sum"])
+        yield ndjson_event("provisional", result={
+            "cheapest_delivery_option": {"pharmacy": cheapest, "delivery_option": None},
+            "alternative_cheapest_option": None,
+            "fastest_delivery_option": None,
+            "alternative_fastest_option": None
+        })
+
+        if not closest_pharmacies["list_pharmacies"] or not cheapest_pharmacies["list_pharmacies"]:
+            yield ndjson_event("error", status=404, error="No pharmacies available for delivery options")
+            return
+
+        # Котировки запрашиваются параллельно; порядок аптек для итогового расчета тот же, что и без потока
+        pharmacies = closest_pharmacies["list_pharmacies"] + cheapest_pharmacies["list_pharmacies"]
+
+        # Аптека может быть и среди ближайших, и среди самых дешевых: котировка запрашивается один раз
+        # и используется на всех ее позициях
+        positions = {}
+        for i, pharmacy in enumerate(pharmacies):
+            positions.setdefault(pharmacy.get("source", {}).get("code") or i, []).append(i)
+
+        async def quote(key):
+            return key, await get_pharmacy_delivery_options(pharmacies[positions[key][0]], user_lat, user_lon)
+
+        tasks = [asyncio.ensure_future(quote(key)) for key in positions]
+        received = {}
+        for next_quote in asyncio.as_completed(tasks):
+            key, pharmacy_results = await next_quote
+            if isinstance(pharmacy_results, JSONResponse):
+                yield ndjson_error(pharmacy_results)
+                return
+            for index in positions[key]:
+                received[index] = pharmacy_results
+
+            delivery_data = [option for i in sorted(received) for option in received[i]]
+            if len(received) < len(pharmacies) and update_ready(delivery_data):
+                update = await best_option(delivery_data)
+                if not isinstance(update, JSONResponse):
+                    yield ndjson_event("update", result=update)
+
+        all_delivery_options = [option for i in sorted(received) for option in received[i]]
         result = await best_option(all_delivery_options)
-        save_response_to_file(result, file_name='data6_final_result.json')
+        if isinstance(result, JSONResponse):
+            yield ndjson_error(result)
+            return
 
-        return result
+        cache_set(result_cache, result_key, result, result_ttl(all_delivery_options))
+        yield ndjson_event("final", result=result)
 
-    except json.JSONDecodeError:
-        return JSONResponse(content={"error": "Invalid JSON format"}, status_code=400)
     except Exception as e:
-        logger.error(f"Unexpected error: {e}")
-        return JSONResponse(content={"error": "An unexpected error occurred"}, status_code=500)
+        logger.error("Unexpected error while streaming best options: %s", e)
+        yield ndjson_event("error", status=500, error="An unexpected error occurred")
+    finally:
+        for task in tasks:
+            task.cancel()
+        admission.release(time.perf_counter() - started)
+
+
+def update_ready(delivery_data):
+    """Хватает ли полученных котировок для промежуточного best_option.
+
+    best_option ожидает либо только варианты с delivery_option, либо только без них
+    (и тогда среди аптек должна быть круглосуточная), поэтому на неполных данных ждем следующие котировки.
+    """
+    if not delivery_data:
+        return False
+    missing = [option["delivery_option"] is None for option in delivery_data]
+    if not any(missing):
+        return True
+    if not all(missing):
+        return False
+    return any(
+        "круглосуточно" in option["pharmacy"]["source"].get("opening_hours", "").lower()
+        for option in delivery_data
+    )
+
+
+def ndjson_event(event, **fields):
+    return json.dumps({"event": event, **fields}, ensure_ascii=False) + "\n"
+
+
+def ndjson_error(response):
+    body = json.loads(response.body.decode('utf-8'))
+    return ndjson_event("error", status=response.status_code, **body)
 
 
 
 async def find_medicines_in_pharmacies(encoded_city, payload):
+    cache_key = (encoded_city, json.dumps(payload, sort_keys=True))
+    cached = cache_get(search_cache, cache_key)
+    if cached is not None:
+        record_upstream("search", {"city": encoded_city, "json": payload}, 200, cached)
+        return cached
+
     async with httpx.AsyncClient() as client:
         try:
-            response = await client.post(URL_SEARCH, params={"city": encoded_city}, json=payload)
+            response = await upstream_post(
+                client, search_scheduler, URL_SEARCH, params={"city": encoded_city}, json=payload
+            )
             response.raise_for_status()
-            data = response.json()
-            # Проверка на наличие ожидаемых ключей в ответе
-            if not isinstance(data, dict) or "result" not in data:
+            # Проверка ответа по схеме
+            data = decode_upstream(SearchResponse, response.content)
+            if data is None:
+                record_upstream("search", {"city": encoded_city, "json": payload}, response.status_code, response.text)
                 return JSONResponse(content={"error": "Invalid response format from search API"}, status_code=502)
+            record_upstream("search", {"city": encoded_city, "json": payload}, response.status_code, data)
+            cache_set(search_cache, cache_key, data, SEARCH_CACHE_TTL)
             return data
         except httpx.RequestError as e:
-            logger.error(f"Request error while accessing URL_SEARCH: {e}")
+            logger.error("Request error while accessing URL_SEARCH: %s", e)
+            record_upstream("search", {"city": encoded_city, "json": payload}, None, None)
             return JSONResponse(content={"error": "Request error while accessing search API"}, status_code=503)
         except httpx.HTTPStatusError as e:
-            logger.error(f"HTTP error while accessing URL_SEARCH: {e}")
+            logger.error("HTTP error while accessing URL_SEARCH: %s", e)
+            record_upstream("search", {"city": encoded_city, "json": payload}, e.response.status_code, e.response.text)
             return JSONResponse(content={"error": f"HTTP error {e.response.status_code}"},
                                 status_code=e.response.status_code)
 
@@ -359,7 +858,7 @@ def is_pharmacy_open_soon(closes_at, opens_at, opening_hours):
         closes_time = datetime.strptime(closes_at, "%Y-%m-%dT%H:%M:%SZ").replace(tzinfo=pytz.UTC).astimezone(almaty_tz)
         opens_time = datetime.strptime(opens_at, "%Y-%m-%dT%H:%M:%SZ").replace(tzinfo=pytz.UTC).astimezone(almaty_tz)
     except ValueError as e:
-        logger.error(f"Time opens\closes parsing error: {e}")
+        logger.error("Time opens\\closes parsing error: %s", e)
         return True  # Если ошибка, считаем, что аптека закрыта для избежания ошибок
 
     # Проверяем, если аптека еще не открылась
@@ -387,7 +886,7 @@ def is_pharmacy_closed(closes_at, opens_at, opening_hours):
         closes_time = datetime.strptime(closes_at, "%Y-%m-%dT%H:%M:%SZ").replace(tzinfo=pytz.UTC).astimezone(almaty_tz)
         opens_time = datetime.strptime(opens_at, "%Y-%m-%dT%H:%M:%SZ").replace(tzinfo=pytz.UTC).astimezone(almaty_tz)
     except ValueError as e:
-        logger.error(f"Time opens\closes parsing error: {e}")
+        logger.error("Time opens\\closes parsing error: %s", e)
         return True  # Если ошибка, считаем, что аптека закрыта для избежания ошибок
 
     # Проверка если аптека закрыта сейчас и еще не открылась
@@ -412,83 +911,114 @@ async def get_delivery_options(pharmacies, user_lat, user_lon):
     results = []
 
     for pharmacy in pharmacies["list_pharmacies"]:
-        source = pharmacy.get("source", {})
-        products = pharmacy.get("products", [])
+        pharmacy_results = await get_pharmacy_delivery_options(pharmacy, user_lat, user_lon)
+        if isinstance(pharmacy_results, JSONResponse):
+            return pharmacy_results  # Возвращаем JSONResponse сразу, если это ошибка
+        results.extend(pharmacy_results)
 
-        if "code" not in source:
-            continue
+    return results
 
-        pharmacy_total_sum = pharmacy.get("total_sum", 0)
 
-        # Формирование списка товаров с учетом оригиналов
-        items = []
-        for product in products:
-            if product["quantity"] >= product["quantity_desired"]:
-                items.append({"sku": product["sku"], "quantity": product["quantity_desired"]})
+async def get_pharmacy_delivery_options(pharmacy, user_lat, user_lon):
+    """Варианты доставки из одной аптеки (запрос к URL_PRICE)."""
 
-        if not items:
-            continue
-        # Формируем запрос для расчета доставки
-        payload = {
-            "items": items,
-            "dst": {
-                "lat": user_lat,
-                "lng": user_lon
-            },
-            "source_code": source["code"]
-        }
+    results = []
 
-        async with httpx.AsyncClient() as client:
-            try:
-                response = await client.post(URL_PRICE, json=payload)
-                response.raise_for_status()
-                delivery_data = response.json()
+    source = pharmacy.get("source", {})
+    products = pharmacy.get("products", [])
 
-                if delivery_data.get("status") == "success":
-                    delivery_options = delivery_data["result"]["delivery"]
+    if "code" not in source:
+        return results
 
-                    for option in delivery_options:
-                        results.append({
-                            "pharmacy": pharmacy,
-                            "total_price": pharmacy_total_sum + option["price"],
-                            "delivery_option": option
-                        })
-                else:
-                    logger.error(f"Unexpected response format from URL_PRICE API: {delivery_data}")
+    pharmacy_total_sum = pharmacy.get("total_sum", 0)
+
+    # Формирование списка товаров с учетом оригиналов
+    items = []
+    for product in products:
+        if product["quantity"] >= product["quantity_desired"]:
+            items.append({"sku": product["sku"], "quantity": product["quantity_desired"]})
+
+    if not items:
+        return results
+    # Формируем запрос для расчета доставки
+    payload = {
+        "items": items,
+        "dst": {
+            "lat": user_lat,
+            "lng": user_lon
+        },
+        "source_code": source["code"]
+    }
+
+    cache_key = json.dumps(payload, sort_keys=True)
+
+    async with httpx.AsyncClient() as client:
+        try:
+            delivery_data = cache_get(quote_cache, cache_key)
+            if delivery_data is None:
+                response = await upstream_post(client, price_scheduler, URL_PRICE, json=payload)
+                response.raise_for_status()
+                # Проверка ответа по схеме
+                delivery_data = decode_upstream(PriceResponse, response.content)
+                if delivery_data is None:
+                    record_upstream("price", {"json": payload}, response.status_code, response.text)
                     return JSONResponse(
-                        content={"error": "Unexpected response format from URL_PRICE API", "details": delivery_data},
+                        content={"error": "Unexpected response format from URL_PRICE API", "details": response.text},
                         status_code=502
                     )
+                if delivery_data["status"] == "success":
+                    cache_set(quote_cache, cache_key, delivery_data, QUOTE_CACHE_TTL)
+            record_upstream("price", {"json": payload}, 200, delivery_data)
+            note_quote_expiry(cache_key)
+
+            if delivery_data["status"] == "success":
+                delivery_options = delivery_data["result"]["delivery"]
+
+                for option in delivery_options:
+                    results.append({
+                        "pharmacy": pharmacy,
+                        "total_price": pharmacy_total_sum + option["price"],
+                        "delivery_option": option
+                    })
+            else:
+                logger.error("Unexpected response format from URL_PRICE API: %s", delivery_data)
+                return JSONResponse(
+                    content={"error": "Unexpected response format from URL_PRICE API", "details": delivery_data},
+                    status_code=502
+                )
 
-            except httpx.RequestError as e:
-                logger.error(f"Request error while accessing URL_PRICE: {e}")
-                results.append({
-                    "pharmacy": pharmacy,
-                    "total_price": pharmacy_total_sum,
-                    "delivery_option": None
-                })
-                continue
-                # return JSONResponse(content={"error": "Request error while accessing URL_PRICE", "details": str(e)},
-                #                     status_code=502)
-
-            except httpx.HTTPStatusError as e:
-                error_details = e.response.json() if e.response.content else {"error": str(e)}
-                logger.error(f"HTTP error while accessing URL_PRICE: {e}")
-
-                results.append({
-                    "pharmacy": pharmacy,
-                    "total_price": pharmacy_total_sum,
-                    "delivery_option": None
-                })
-                continue
+        except httpx.RequestError as e:
+            logger.error("Request error while accessing URL_PRICE: %s", e)
+            record_upstream("price", {"json": payload}, None, None)
+            note_quote_expiry(None)
+            results.append({
+                "pharmacy": pharmacy,
+                "total_price": pharmacy_total_sum,
+                "delivery_option": None
+            })
+            return results
+            # return JSONResponse(content={"error": "Request error while accessing URL_PRICE", "details": str(e)},
+            #                     status_code=502)
+
+        except httpx.HTTPStatusError as e:
+            logger.error("HTTP error while accessing URL_PRICE: %s", e)
+            record_upstream("price", {"json": payload}, e.response.status_code, e.response.text)
+            note_quote_expiry(None)
 
-                # return JSONResponse(
-                #     content={
-                #         "error": f"HTTP error {e.response.status_code}",
-                #         "details": error_details
-                #     },
-                #     status_code=e.response.status_code
-                # )
+            results.append({
+                "pharmacy": pharmacy,
+                "total_price": pharmacy_total_sum,
+                "delivery_option": None
+            })
+            return results
+
+            # return JSONResponse(
+            #     content={
+            #         "error": f"HTTP error {e.response.status_code}",
+            #         "details": error_details
+            #     },
+            #     status_code=e.response.status_code
+            # )
 
     return results
 
@@ -555,7 +1085,7 @@ async def best_option(delivery_data):
         opening_hours = source.get("opening_hours", "")
 
         if 'code' not in source:
-            logger.warning(f"Missing 'code' in pharmacy source: {source}")
+            logger.warning("Missing 'code' in pharmacy source: %s", source)
             continue
 
         pharmacy_closed = is_pharmacy_closed(closes_at, opens_at, opening_hours)
@@ -568,7 +1098,7 @@ async def best_option(delivery_data):
                 if not pharmacy_closes_soon:
                     alternative_cheapest_option = None
                 else:
-                    logger.info(f"Step 4: Pharmacy {source['code']} closes soon, looking for an alternative")
+                    logger.info("Step 4: Pharmacy %s closes soon, looking for an alternative", source['code'])
                     # Ищем самую дешевую аптеку, которая не закрывается скоро
                     if not alternative_cheapest_option:
                         for alt_option in delivery_data:
@@ -586,7 +1116,8 @@ async def best_option(delivery_data):
                                     (alternative_cheapest_option is None or alt_option["total_price"] <
                                      alternative_cheapest_option["total_price"]):
                                 logger.info(
-                                    f"Step 5: Found alternative_cheapest_option with code {alt_source.get('code')}, works longer than 1 hour, and price {alt_option['total_price']}")
+                                    "Step 5: Found alternative_cheapest_option with code %s, works longer than 1 hour, and price %s",
+                                    alt_source.get('code'), alt_option['total_price'])
                                 alternative_cheapest_option = alt_option
 
             # Самая быстрая открытая аптека
@@ -597,7 +1128,7 @@ async def best_option(delivery_data):
                     alternative_fastest_option = None
                 else:
                     logger.info(
-                        f"Step 4.1: Pharmacy {source['code']} closes soon, looking for an alternative fastest pharmacy")
+                        "Step 4.1: Pharmacy %s closes soon, looking for an alternative fastest pharmacy", source['code'])
                     # Ищем самую быструю аптеку, которая не закрывается скоро
                     if not alternative_fastest_option:
                         for alt_option in delivery_data:
@@ -615,7 +1146,8 @@ async def best_option(delivery_data):
                                     (alternative_fastest_option is None or alt_option["delivery_option"]["eta"] <
                                      alternative_fastest_option["delivery_option"]["eta"]):
                                 logger.info(
-                                    f"Step 5.1: Found alternative_fastest_option with code {alt_source.get('code')}, works longer than 1 hour, and eta {alt_option['delivery_option']['eta']}")
+                                    "Step 5.1: Found alternative_fastest_option with code %s, works longer than 1 hour, and eta %s",
+                                    alt_source.get('code'), alt_option['delivery_option']['eta'])
                                 alternative_fastest_option = alt_option
 
     # Второй проход для анализа закрытых аптек с учетом уже выбранных открытых аптек
@@ -673,7 +1205,7 @@ async def best_option(delivery_data):
 
 
     logger.info(
-        f"Step 8: Returning the standard results"
+        "Step 8: Returning the standard results"
     )
     return {
         "cheapest_delivery_option": cheapest_open_pharmacy,
@@ -685,6 +1217,10 @@ async def best_option(delivery_data):
 
 #  функция для проверки выбранных на каждой стадии отбора аптек (сохраняет списки аптек в файлы локально)
 def save_response_to_file(data, file_name='data.json'):
+    # Отладочные файлы пишутся только при LOG_LEVEL=DEBUG, чтобы не нагружать обработку запросов
+    if not logger.isEnabledFor(logging.DEBUG):
+        return
+
     try:
         # Проверяем, является ли data объектом JSONResponse
         if isinstance(data, JSONResponse):
@@ -696,9 +1232,652 @@ def save_response_to_file(data, file_name='data.json'):
         with open(file_name, 'w', encoding='utf-8') as file:
             json.dump(data, file, ensure_ascii=False, indent=4)
 
-        print(f"Данные успешно сохранены в файл: {file_name}")
+        logger.debug("Данные успешно сохранены в файл: %s", file_name)
     except Exception as e:
-        print(f"Ошибка при сохранении данных: {e}")
+        logger.error("Ошибка при сохранении данных: %s", e)
+
+
+def cache_get(cache, key):
+    """Возвращает значение из кэша или None, если записи нет или срок ее жизни истек."""
+    entry = cache.get(key)
+    if entry is None or entry[0] <= time.monotonic():
+        cache_counters[id(cache), "misses"] += 1
+        return None
+    cache_counters[id(cache), "hits"] += 1
+    return entry[1]
+
+
+def cache_get_stale(cache, key, max_age):
+    """Возвращает значение, истекшее не более max_age секунд назад (для деградированного режима)."""
+    entry = cache.get(key)
+    if entry is None or entry[0] + max_age <= time.monotonic():
+        return None
+    return entry[1]
+
+
+def cache_set(cache, key, value, ttl):
+    """Сохраняет значение в кэш на ttl секунд, вытесняя устаревшие записи при переполнении."""
+    if ttl <= 0:
+        return
+
+    now = time.monotonic()
+    if key not in cache and len(cache) >= CACHE_MAX_ENTRIES:
+        for stale_key in [k for k, (expires_at, _) in cache.items() if expires_at <= now]:
+            del cache[stale_key]
+        if len(cache) >= CACHE_MAX_ENTRIES:
+            del cache[min(cache, key=lambda k: cache[k][0])]
+
+    cache[key] = (now + ttl, value)
+
+
+def note_quote_expiry(cache_key):
+    """Запоминает, до какого момента актуальны котировки доставки текущего запроса."""
+    context = request_context.get()
+    if context is None:
+        return
+    # Котировка не попала в кэш (ошибка или кэш отключен) - результат кэшировать нельзя
+    entry = quote_cache.get(cache_key) if cache_key is not None else None
+    expires_at = entry[0] if entry else time.monotonic()
+    context["quotes_expire_at"] = min(context.get("quotes_expire_at", expires_at), expires_at)
+
+
+def next_status_change(delivery_data, current_time):
+    """Ближайший момент, когда у одной из аптек изменится статус: открытие, закрытие или "закроется через 1 час"."""
+    changes = []
+    for option in delivery_data:
+        source = option["pharmacy"].get("source", {})
+        if "круглосуточно" in (source.get("opening_hours") or "").lower():
+            continue
+        try:
+            closes_time = datetime.strptime(source["closes_at"], "%Y-%m-%dT%H:%M:%SZ").replace(tzinfo=pytz.UTC)
+            opens_time = datetime.strptime(source["opens_at"], "%Y-%m-%dT%H:%M:%SZ").replace(tzinfo=pytz.UTC)
+        except (KeyError, TypeError, ValueError):
+            continue  # Такая аптека всегда считается закрытой, статус не меняется
+
+        # Границы из is_pharmacy_closed и is_pharmacy_open_soon
+        boundaries = (opens_time, closes_time - timedelta(hours=1), closes_time, opens_time + timedelta(days=1))
+        changes.extend(moment for moment in boundaries if moment > current_time)
+
+    return min(changes, default=None)
+
+
+def result_ttl(delivery_data):
+    """Время жизни итогового ответа: до смены статуса аптек, но не дольше котировок доставки."""
+    context = request_context.get() or {}
+    ttl = context.get("quotes_expire_at", time.monotonic()) - time.monotonic()
+
+    current_time = datetime.now(pytz.UTC)
+    change = next_status_change(delivery_data, current_time)
+    if change is not None:
+        ttl = min(ttl, (change - current_time).total_seconds())
+    return ttl
+
+
+def record_request_key(encoded_city, payload):
+    """Учитывает корзину запроса для последующего прогрева кэшей."""
+    key = (encoded_city, json.dumps(payload, sort_keys=True))
+    stats = request_keys.get(key)
+    if stats is None:
+        if len(request_keys) >= WARMUP_MAX_KEYS:
+            # Оставляем только более популярную половину корзин
+            popular = sorted(request_keys.items(), key=lambda x: x[1]["count"], reverse=True)
+            request_keys.clear()
+            request_keys.update(popular[:WARMUP_MAX_KEYS // 2])
+        stats = request_keys[key] = {"count": 0}
+
+    # Координаты клиента не сохраняются: прогревается только кэш поиска, который от них не зависит
+    stats["count"] += 1
+    stats["last_seen"] = time.time()
+
+
+def load_request_keys(file_name=WARMUP_KEYS_FILE):
+    try:
+        with open(file_name, encoding='utf-8') as file:
+            for entry in json.load(file):
+                key = (entry["city"], json.dumps(entry["skus"], sort_keys=True))
+                request_keys[key] = {
+                    "count": entry["count"],
+                    "last_seen": entry.get("last_seen", time.time()),
+                }
+    except FileNotFoundError:
+        pass
+    except (ValueError, KeyError, TypeError) as e:
+        logger.error("Failed to load warm-up keys from %s: %s", file_name, e)
+
+
+def save_request_keys(file_name=WARMUP_KEYS_FILE):
+    entries = [
+        {"city": city, "skus": json.loads(skus), **stats}
+        for (city, skus), stats in request_keys.items()
+    ]
+    try:
+        with open(file_name, 'w', encoding='utf-8') as file:
+            json.dump(entries, file, ensure_ascii=False)
+    except OSError as e:
+        logger.error("Failed to save warm-up keys to %s: %s", file_name, e)
+
+
+async def prefetch_popular_keys():
+    """Заполняет кэш поиска для top-N популярных корзин с ограничением частоты."""
+    recent = [item for item in request_keys.items() if time.time() - item[1]["last_seen"] <= WARMUP_KEY_MAX_AGE]
+    popular = sorted(recent, key=lambda x: x[1]["count"], reverse=True)[:WARMUP_TOP_N]
+
+    for (encoded_city, skus), _ in popular:
+        try:
+            await find_medicines_in_pharmacies(encoded_city, json.loads(skus))
+        except Exception as e:
+            logger.error("Warm-up failed for city %s: %s", encoded_city, e)
+        if WARMUP_RATE > 0:
+            await asyncio.sleep(1 / WARMUP_RATE)
+
+    logger.info("Warm-up finished for %s baskets", len(popular))
+
+
+async def warmup_loop():
+    try:
+        await asyncio.wait_for(prefetch_popular_keys(), timeout=WARMUP_TIMEOUT)
+    except asyncio.TimeoutError:
+        logger.warning("Warm-up did not finish in %s seconds", WARMUP_TIMEOUT)
+    except Exception as e:
+        logger.error("Warm-up failed: %s", e)
+    finally:
+        # Сервис готов и без прогрева, иначе /ready отвечал бы 503 до перезапуска
+        warmup_state["ready"] = True
+
+    while True:
+        await asyncio.sleep(WARMUP_INTERVAL)
+        try:
+            save_request_keys()
+            await prefetch_popular_keys()
+        except Exception as e:
+            logger.error("Scheduled warm-up failed: %s", e)
+
+
+@app.on_event("startup")
+async def start_warmup():
+    load_request_keys()
+    warmup_state["task"] = asyncio.create_task(warmup_loop())
+
+
+@app.on_event("shutdown")
+async def stop_warmup():
+    if warmup_state["task"]:
+        warmup_state["task"].cancel()
+    save_request_keys()
+
+
+def start_recording(context):
+    """Начинает запись upstream-ответов текущего запроса, если задан RECORD_FILE.
+
+    Потоковые запросы (stream_best_options) не записываются: replay.py воспроизводит только обычный ответ.
+    """
+    if not RECORD_FILE:
+        return None
+    recording = context["recording"] = {"search": [], "price": []}
+    return recording
+
+
+def record_upstream(upstream, request_params, status, body):
+    context = request_context.get()
+    if context is None or "recording" not in context:
+        return
+    context["recording"][upstream].append({"request": request_params, "status": status, "body": body})
+
+
+async def save_recording(request_data, recording, result):
+    """Дописывает запрос, ответы upstream и итоговый ответ строкой в RECORD_FILE (JSON Lines)."""
+    if isinstance(result, JSONResponse):
+        response = {"status": result.status_code, "body": json.loads(result.body.decode('utf-8'))}
+    else:
+        response = {"status": 200, "body": result}
+
+    entry = {"ts": time.time(), "request": request_data, **recording, "response": response}
+    # Запись в файл - в пуле потоков, чтобы не блокировать цикл событий
+    await asyncio.get_running_loop().run_in_executor(None, append_recording, json.dumps(entry, ensure_ascii=False))
+
+
+def append_recording(line):
+    try:
+        with recording_lock, open(RECORD_FILE, 'a', encoding='utf-8') as file:
+            file.write(line + "\n")
+    except OSError as e:
+        logger.error("Failed to save recording to %s: %s", RECORD_FILE, e)
+
+
+class AdmissionController:
+    """Ограничивает число одновременно обрабатываемых запросов.
+
+    Лимит подстраивается под задержку (AIMD): растет на ~1 за каждые `limit` запросов,
+    уложившихся в ADMISSION_LATENCY_SLO, и уменьшается на 10% при превышении.
+    Запросы сверх лимита ждут в очереди по приоритету клиента; при переполнении очереди
+    или по истечении ADMISSION_QUEUE_TIMEOUT запрос отклоняется.
+    """
+
+    def __init__(self, limit, min_limit, max_limit, max_queue, queue_timeout, latency_slo):
+        self.limit = float(limit)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.latency_slo = latency_slo
+        self.in_flight = 0
+        self.waiters = []  # куча [приоритет, порядковый номер, future]
+        self.sequence = itertools.count()
+        self.latency_ewma = None
+        self.counters = collections.Counter()
+
+    async def acquire(self, priority):
+        """True - запрос допущен (обязателен release), False - запрос нужно отклонить."""
+        if self.in_flight < int(self.limit) and not self.waiters:
+            self.in_flight += 1
+            self.counters["admitted"] += 1
+            return True
+
+        if len(self.waiters) >= self.max_queue:
+            # Отмененные ожидания еще могут быть в очереди до своего except CancelledError
+            self.waiters = [entry for entry in self.waiters if not entry[2].done()]
+            heapq.heapify(self.waiters)
+
+        if len(self.waiters) >= self.max_queue:
+            # Полная очередь: вытесняем самый неприоритетный запрос, если новый важнее
+            worst = max(self.waiters)
+            if priority >= worst[0]:
+                self.counters["shed"] += 1
+                return False
+            self.remove_waiter(worst)
+            worst[2].set_result(False)
+
+        future = asyncio.get_running_loop().create_future()
+        entry = [priority, next(self.sequence), future]
+        heapq.heappush(self.waiters, entry)
+        try:
+            admitted = await asyncio.wait_for(future, self.queue_timeout)
+        except asyncio.TimeoutError:
+            self.remove_waiter(entry)
+            admitted = False
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled() and future.result():
+                self.release(None)  # Слот уже был передан этому запросу
+            else:
+                self.remove_waiter(entry)
+            raise
+
+        self.counters["admitted" if admitted else "shed"] += 1
+        return admitted
+
+    def remove_waiter(self, entry):
+        if entry in self.waiters:
+            self.waiters.remove(entry)
+            heapq.heapify(self.waiters)
+
+    def release(self, latency):
+        if latency is not None:
+            self.update_limit(latency)
+
+        self.in_flight -= 1
+        # Освободившиеся слоты передаются ожидающим в порядке приоритета
+        while self.waiters and self.in_flight < int(self.limit):
+            _, _, future = heapq.heappop(self.waiters)
+            if not future.done():
+                future.set_result(True)
+                self.in_flight += 1
+
+    def update_limit(self, latency):
+        self.latency_ewma = latency if self.latency_ewma is None else 0.9 * self.latency_ewma + 0.1 * latency
+        if latency > self.latency_slo:
+            self.limit = max(self.min_limit, self.limit * 0.9)
+        elif self.in_flight >= int(self.limit) or self.waiters:
+            # Увеличиваем лимит, только если он действительно был исчерпан
+            self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+
+    def retry_after(self):
+        """Оценка в секундах, через сколько очередь успеет разойтись."""
+        latency = self.latency_ewma or self.latency_slo
+        return max(1, math.ceil(latency * (len(self.waiters) + 1) / max(int(self.limit), 1)))
+
+    def stats(self):
+        return {
+            "limit": int(self.limit),
+            "in_flight": self.in_flight,
+            "queued": len(self.waiters),
+            "latency_ewma": self.latency_ewma,
+            **self.counters,
+        }
+
+
+admission = AdmissionController(
+    ADMISSION_INITIAL_CONCURRENCY,
+    ADMISSION_MIN_CONCURRENCY,
+    ADMISSION_MAX_CONCURRENCY,
+    ADMISSION_MAX_QUEUE,
+    ADMISSION_QUEUE_TIMEOUT,
+    ADMISSION_LATENCY_SLO,
+)
+
+
+def shed_response(result_key):
+    """Ответ на отклоненный запрос: устаревший результат из кэша (деградированный режим) или 503."""
+    stale_result = cache_get_stale(result_cache, result_key, ADMISSION_STALE_MAX_AGE)
+    if stale_result is not None:
+        admission.counters["degraded"] += 1
+        return JSONResponse(content=stale_result, headers={"X-Degraded": "stale-cache"})
+
+    return JSONResponse(
+        content={"error": "Service is overloaded, please retry later"},
+        status_code=503,
+        headers={"Retry-After": str(admission.retry_after())},
+    )
+
+
+class UpstreamScheduler:
+    """Токен-бакет для исходящих запросов к одному upstream, общий для всего процесса.
+
+    Когда токенов нет, запросы ждут в очередях по потокам (поток - один входящий запрос или прогрев)
+    и получают токены по кругу, поэтому большая корзина не задерживает остальные запросы больше,
+    чем на один запрос к upstream за раз. Ответ 429 обнуляет бакет и приостанавливает выдачу токенов
+    на Retry-After.
+    """
+
+    def __init__(self, name, rate, burst):
+        self.name = name
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.tokens = float(self.burst)
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.flows = collections.OrderedDict()  # поток -> очередь future
+        self.timer = None  # (цикл событий, TimerHandle) следующей выдачи токенов
+        self.waits = collections.deque(maxlen=1000)  # последние ожидания в очереди, секунды
+        self.counters = collections.Counter()
+
+    def refill(self):
+        now = time.monotonic()
+        if self.rate > 0:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        else:
+            self.tokens = float(self.burst)
+        self.updated = now
+        return now
+
+    def try_take(self):
+        now = self.refill()
+        if now < self.paused_until or self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+    async def acquire(self, flow, timeout=None):
+        """Ждет токен; asyncio.TimeoutError, если его не удалось получить за timeout секунд."""
+        started = time.monotonic()
+        if not self.flows and self.try_take():
+            self.counters["granted"] += 1
+            self.waits.append(0.0)
+            return 0.0
+
+        if timeout is not None and self.paused_until - time.monotonic() >= timeout:
+            # Пауза после 429 закончится позже срока - ждать бессмысленно
+            self.counters["timed_out"] += 1
+            raise asyncio.TimeoutError
+
+        future = asyncio.get_running_loop().create_future()
+        self.flows.setdefault(flow, collections.deque()).append(future)
+        self.dispatch()
+        try:
+            await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            self.remove_waiter(flow, future)
+            self.counters["timed_out"] += 1
+            raise
+        except asyncio.CancelledError:
+            self.remove_waiter(flow, future)
+            raise
+
+        wait = time.monotonic() - started
+        self.counters["granted"] += 1
+        self.counters["delayed"] += 1
+        self.waits.append(wait)
+        return wait
+
+    def remove_waiter(self, flow, future):
+        waiters = self.flows.get(flow)
+        if waiters is not None and future in waiters:
+            waiters.remove(future)
+            if not waiters:
+                del self.flows[flow]
+
+    def dispatch(self):
+        """Выдает доступные токены потокам по кругу и планирует следующий вызов."""
+        while self.flows and self.try_take():
+            flow, waiters = next(iter(self.flows.items()))
+            future = waiters.popleft()
+            if waiters:
+                self.flows.move_to_end(flow)
+            else:
+                del self.flows[flow]
+            if future.done():
+                self.tokens += 1  # Ожидание уже отменено
+            else:
+                future.set_result(None)
+
+        if self.flows:
+            loop = asyncio.get_running_loop()
+            if self.timer is None or self.timer[0] is not loop:
+                delay = max(self.paused_until - time.monotonic(), (1 - self.tokens) / self.rate if self.rate > 0 else 0)
+                self.timer = (loop, loop.call_later(max(delay, 0.001), self.on_timer))
+
+    def on_timer(self):
+        self.timer = None
+        self.dispatch()
+
+    def throttle(self, retry_after):
+        """Обратная связь от 429: бакет пуст, новые токены - не раньше чем через retry_after секунд."""
+        self.counters["throttled"] += 1
+        self.refill()
+        self.tokens = 0.0
+        self.paused_until = max(self.paused_until, time.monotonic() + retry_after)
+
+    def stats(self):
+        waits = sorted(self.waits)
+        return {
+            "rate": self.rate,
+            "burst": self.burst,
+            "tokens": round(self.tokens, 2),
+            "queued": sum(len(waiters) for waiters in self.flows.values()),
+            "flows": len(self.flows),
+            "paused_for": max(0.0, self.paused_until - time.monotonic()),
+            "wait_ms": {
+                "mean": sum(waits) / len(waits) * 1000 if waits else None,
+                "p50": waits[len(waits) // 2] * 1000 if waits else None,
+                "p99": waits[min(len(waits) - 1, len(waits) * 99 // 100)] * 1000 if waits else None,
+                "max": waits[-1] * 1000 if waits else None,
+            },
+            **self.counters,
+        }
+
+
+search_scheduler = UpstreamScheduler("URL_SEARCH", URL_SEARCH_RATE, URL_SEARCH_BURST)
+price_scheduler = UpstreamScheduler("URL_PRICE", URL_PRICE_RATE, URL_PRICE_BURST)
+upstream_schedulers = {scheduler.name: scheduler for scheduler in (search_scheduler, price_scheduler)}
+
+
+def parse_retry_after(value):
+    """Retry-After в секундах: число или HTTP-дата."""
+    if not value:
+        return UPSTREAM_DEFAULT_RETRY_AFTER
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, (parsedate_to_datetime(value) - datetime.now(pytz.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return UPSTREAM_DEFAULT_RETRY_AFTER
+
+
+async def upstream_post(client, scheduler, url, **kwargs):
+    """POST к upstream через общий планировщик; после 429 запрос повторяется, когда бакет снова откроется."""
+    context = request_context.get()
+    flow = id(context) if context is not None else None
+
+    for attempt in range(UPSTREAM_429_RETRIES + 1):
+        started = time.monotonic()
+        try:
+            await scheduler.acquire(flow, UPSTREAM_QUEUE_TIMEOUT)
+        except asyncio.TimeoutError:
+            # Токен не получен вовремя - как если бы upstream ответил 429 (вызывающий код вернет delivery_option: None)
+            logger.warning("%s queue timeout after %.1f s", scheduler.name, UPSTREAM_QUEUE_TIMEOUT)
+            return httpx.Response(429, text="Upstream queue timeout", request=httpx.Request("POST", url))
+        finally:
+            profile_add_stage("upstream_queue", time.monotonic() - started)
+
+        with profile_upstream(scheduler.name):
+            response = await client.post(url, **kwargs)
+        if response.status_code != 429:
+            return response
+        retry_after = min(parse_retry_after(response.headers.get("retry-after")), UPSTREAM_MAX_RETRY_AFTER)
+        logger.warning("%s rate limited, retry after %.1f s", scheduler.name, retry_after)
+        scheduler.throttle(retry_after)
+        profile_count("upstream_throttled", 1)
+        if retry_after > UPSTREAM_RETRY_BUDGET:
+            break  # Слишком долго ждать повтора, отдаем 429 вызывающему коду
+    return response
+
+
+def profiling_allowed(request):
+    """Профилирование доступно только с заголовком X-Profile-Token, совпадающим с PROFILE_TOKEN."""
+    token = request.headers.get("x-profile-token")
+    # Сравниваются байты: starlette декодирует заголовки как latin-1, а compare_digest не принимает не-ASCII строки
+    return bool(PROFILE_TOKEN) and token is not None and \
+        hmac.compare_digest(token.encode("latin-1"), PROFILE_TOKEN.encode())
+
+
+def start_profile(context):
+    profile = context["profile"] = {
+        "started": time.perf_counter(),
+        "stages_ms": {},
+        "upstream": [],
+        "counts": {},
+    }
+    return profile
+
+
+def current_profile():
+    context = request_context.get()
+    return context.get("profile") if context is not None else None
+
+
+def profile_add_stage(name, seconds):
+    profile = current_profile()
+    if profile is not None:
+        profile["stages_ms"][name] = profile["stages_ms"].get(name, 0) + seconds * 1000
+
+
+def profile_count(name, value):
+    profile = current_profile()
+    if profile is not None:
+        profile["counts"][name] = profile["counts"].get(name, 0) + value
+
+
+@contextmanager
+def profile_stage(name, cpu=False):
+    """Время этапа обработки запроса (и процессорное время потока при cpu=True)."""
+    started = time.perf_counter()
+    cpu_started = time.thread_time()
+    try:
+        yield
+    finally:
+        profile_add_stage(name, time.perf_counter() - started)
+        if cpu:
+            profile_add_stage(f"{name}_cpu", time.thread_time() - cpu_started)
+
+
+@contextmanager
+def profile_upstream(name):
+    """Время ожидания одного запроса к upstream."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        profile = current_profile()
+        if profile is not None:
+            profile["upstream"].append({"upstream": name, "ms": (time.perf_counter() - started) * 1000})
+
+
+def attach_profile(result, profile):
+    """Добавляет разбивку времени к ответу, не изменяя закэшированный результат."""
+    report = {
+        "total_ms": (time.perf_counter() - profile["started"]) * 1000,
+        "stages_ms": profile["stages_ms"],
+        "upstream": profile["upstream"],
+        "upstream_wait_ms": sum(call["ms"] for call in profile["upstream"]),
+        "counts": profile["counts"],
+    }
+    if isinstance(result, JSONResponse):
+        body = json.loads(result.body.decode('utf-8'))
+        # Заголовки (Retry-After, X-Degraded) сохраняются, длина тела пересчитывается
+        headers = {name: value for name, value in result.headers.items() if name.lower() != "content-length"}
+        return JSONResponse(content={**body, "profile": report}, status_code=result.status_code, headers=headers)
+    return {**result, "profile": report}
+
+
+def sample_stacks(thread_id, seconds, interval):
+    """Семплирует стек потока и возвращает счетчики свернутых стеков (формат flamegraph.pl / speedscope)."""
+    counts = collections.Counter()
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        frame = sys._current_frames().get(thread_id)
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+            frame = frame.f_back
+        if stack:
+            counts[";".join(reversed(stack))] += 1
+        time.sleep(interval)
+    return counts
+
+
+# Семплирующий профайлер цикла событий: GET /debug/profile?seconds=10 с заголовком X-Profile-Token
+@app.get("/debug/profile")
+async def sampling_profile(request: Request, seconds: float = 10, interval: float = 0.005):
+    if not profiling_allowed(request):
+        return JSONResponse(content={"error": "Forbidden"}, status_code=403)
+
+    counts = await asyncio.get_running_loop().run_in_executor(
+        None, sample_stacks, threading.get_ident(), min(seconds, PROFILE_MAX_SECONDS), max(interval, 0.001)
+    )
+    return PlainTextResponse("\n".join(f"{stack} {count}" for stack, count in counts.most_common()))
+
+
+# Готовность сервиса: отвечает 200 только после завершения (или таймаута) прогрева
+@app.get("/ready")
+async def readiness():
+    if not warmup_state["ready"]:
+        return JSONResponse(content={"status": "warming_up"}, status_code=503)
+    return {"status": "ready"}
+
+
+# Статистика воркера: размер и попадания кэшей, память процесса
+@app.get("/stats")
+async def stats():
+    cache_stats = {}
+    for name, cache in caches.items():
+        hits, misses = cache_counters[id(cache), "hits"], cache_counters[id(cache), "misses"]
+        cache_stats[name] = {
+            "entries": len(cache),
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": hits / (hits + misses) if hits + misses else None,
+        }
+
+    return {
+        "shard_id": SHARD_ID,
+        "caches": cache_stats,
+        "request_keys": len(request_keys),
+        "admission": admission.stats(),
+        "upstream": {name: scheduler.stats() for name, scheduler in upstream_schedulers.items()},
+        "max_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
 
 
 # мок ручки для возврата тестовых результатов запроса поиска аптек
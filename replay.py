@@ -0,0 +1,208 @@
+"""Воспроизведение записанных запросов /best_options для проверки производительности и поведения.
+
+Запись: запустите сервис с RECORD_FILE=recordings.jsonl - каждый запрос /best_options
+сохраняется вместе с ответами URL_SEARCH и URL_PRICE.
+
+Воспроизведение:
+    python replay.py upstream recordings.jsonl --port 9000
+        локальный URL_SEARCH (/search) и URL_PRICE (/price), отдающий записанные ответы;
+        тестируемую сборку запускают с URL_SEARCH=http://127.0.0.1:9000/search
+        и URL_PRICE=http://127.0.0.1:9000/price
+    python replay.py run recordings.jsonl --target http://127.0.0.1:8000 --speed 10 --report build_a.json
+        отправляет записанные запросы с исходными интервалами (ускоренными в --speed раз,
+        0 - без пауз) и печатает распределение задержек и расхождения с записанными ответами
+    python replay.py compare build_a.json build_b.json
+        сравнивает задержки и ответы двух сборок
+"""
+import argparse
+import asyncio
+import json
+import math
+import time
+
+import httpx
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, Response
+
+
+def load_recordings(file_name):
+    with open(file_name, encoding='utf-8') as file:
+        return [json.loads(line) for line in file if line.strip()]
+
+
+def upstream_key(*parts):
+    return json.dumps(parts, sort_keys=True, ensure_ascii=False)
+
+
+def has_request_error(recording):
+    """Запись содержит сетевую ошибку upstream, которую мок воспроизводит только приближенно."""
+    return any(entry["status"] is None for entry in recording["search"] + recording["price"])
+
+
+def recorded_response(entry):
+    if entry["status"] is None:
+        # Исходный запрос завершился сетевой ошибкой - ближайший аналог (такие записи не сравниваются в run)
+        return JSONResponse(content={"error": "recorded request error"}, status_code=503)
+    if isinstance(entry["body"], str):
+        return Response(content=entry["body"], status_code=entry["status"])
+    return JSONResponse(content=entry["body"], status_code=entry["status"])
+
+
+def build_upstream_app(recordings):
+    """Мок URL_SEARCH и URL_PRICE, отдающий записанные ответы по совпадению тела запроса."""
+    responses = {}
+    for recording in recordings:
+        for entry in recording["search"]:
+            responses[upstream_key("search", entry["request"]["city"], entry["request"]["json"])] = entry
+        for entry in recording["price"]:
+            responses[upstream_key("price", entry["request"]["json"])] = entry
+
+    upstream_app = FastAPI()
+
+    @upstream_app.post("/search")
+    async def search(request: Request):
+        entry = responses.get(upstream_key("search", request.query_params.get("city"), await request.json()))
+        if entry is None:
+            return JSONResponse(content={"error": "not recorded"}, status_code=404)
+        return recorded_response(entry)
+
+    @upstream_app.post("/price")
+    async def price(request: Request):
+        entry = responses.get(upstream_key("price", await request.json()))
+        if entry is None:
+            return JSONResponse(content={"error": "not recorded"}, status_code=404)
+        return recorded_response(entry)
+
+    return upstream_app
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, math.ceil(p / 100 * len(ordered)) - 1)]
+
+
+def latency_summary(latencies):
+    return {
+        "count": len(latencies),
+        "mean": sum(latencies) / len(latencies) if latencies else None,
+        "p50": percentile(latencies, 50),
+        "p90": percentile(latencies, 90),
+        "p99": percentile(latencies, 99),
+        "max": max(latencies) if latencies else None,
+    }
+
+
+async def replay(recordings, target, speed, timeout):
+    results = [None] * len(recordings)
+    first_ts = recordings[0]["ts"] if recordings else 0
+
+    async with httpx.AsyncClient(base_url=target, timeout=timeout) as client:
+        async def send(index, recording):
+            if speed > 0:
+                await asyncio.sleep(max(0.0, (recording["ts"] - first_ts) / speed - (time.monotonic() - started)))
+            request_started = time.perf_counter()
+            try:
+                response = await client.post("/best_options", json=recording["request"])
+                status, body = response.status_code, response.json()
+            except (httpx.HTTPError, ValueError) as e:
+                status, body = None, {"error": str(e)}
+            results[index] = {
+                "status": status,
+                "body": body,
+                "latency_ms": (time.perf_counter() - request_started) * 1000,
+            }
+
+        started = time.monotonic()
+        if speed > 0:
+            await asyncio.gather(*(send(i, recording) for i, recording in enumerate(recordings)))
+        else:
+            for i, recording in enumerate(recordings):
+                await send(i, recording)
+
+    return results
+
+
+def diff_indices(expected, actual, skip=()):
+    return [
+        i for i, (a, b) in enumerate(zip(expected, actual))
+        if i not in skip and (a["status"] != b["status"] or a["body"] != b["body"])
+    ]
+
+
+def print_latency(title, summary):
+    values = ", ".join(
+        f"{name}={value:.1f}ms" for name, value in summary.items() if name != "count" and value is not None
+    )
+    print(f"{title}: {summary['count']} requests, {values}")
+
+
+def run_command(args):
+    recordings = load_recordings(args.recordings)
+    results = asyncio.run(replay(recordings, args.target, args.speed, args.timeout))
+
+    summary = latency_summary([r["latency_ms"] for r in results])
+    skipped = {i for i, recording in enumerate(recordings) if has_request_error(recording)}
+    changed = diff_indices([r["response"] for r in recordings], results, skipped)
+    print_latency("Latency", summary)
+    print(f"Responses differing from recording: {len(changed)} {changed[:20]}")
+    if skipped:
+        print(f"Not compared (recorded upstream network errors): {len(skipped)}")
+
+    if args.report:
+        with open(args.report, 'w', encoding='utf-8') as file:
+            json.dump({"latency_ms": summary, "results": results}, file, ensure_ascii=False, indent=4)
+
+
+def compare_command(args):
+    with open(args.baseline, encoding='utf-8') as file:
+        baseline = json.load(file)
+    with open(args.candidate, encoding='utf-8') as file:
+        candidate = json.load(file)
+
+    print_latency("Baseline ", baseline["latency_ms"])
+    print_latency("Candidate", candidate["latency_ms"])
+    for name in ("p50", "p90", "p99"):
+        before, after = baseline["latency_ms"][name], candidate["latency_ms"][name]
+        if before and after:
+            print(f"{name}: {after - before:+.1f}ms ({(after / before - 1) * 100:+.1f}%)")
+
+    changed = diff_indices(baseline["results"], candidate["results"])
+    print(f"Responses differing between builds: {len(changed)} {changed[:20]}")
+
+
+def upstream_command(args):
+    uvicorn.run(build_upstream_app(load_recordings(args.recordings)), host=args.host, port=args.port)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    upstream = commands.add_parser("upstream", help="serve recorded URL_SEARCH/URL_PRICE responses")
+    upstream.add_argument("recordings")
+    upstream.add_argument("--host", default="127.0.0.1")
+    upstream.add_argument("--port", type=int, default=9000)
+    upstream.set_defaults(handler=upstream_command)
+
+    run = commands.add_parser("run", help="replay recorded requests against a running build")
+    run.add_argument("recordings")
+    run.add_argument("--target", default="http://127.0.0.1:8000")
+    run.add_argument("--speed", type=float, default=1.0, help="rate multiplier, 0 sends requests back to back")
+    run.add_argument("--timeout", type=float, default=30.0)
+    run.add_argument("--report", help="save latencies and responses for compare")
+    run.set_defaults(handler=run_command)
+
+    compare = commands.add_parser("compare", help="compare two run reports")
+    compare.add_argument("baseline")
+    compare.add_argument("candidate")
+    compare.set_defaults(handler=compare_command)
+
+    args = parser.parse_args()
+    args.handler(args)
+
+
+if __name__ == "__main__":
+    main()
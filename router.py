@@ -0,0 +1,291 @@
+"""Фронт-роутер с привязкой городов к воркерам (шардирование теплого состояния по encoded_city).
+
+Каждый город (хэш из поля "city") по консистентному хэшированию закрепляется за одним воркером,
+поэтому кэши поиска, котировок и итоговых ответов каждого воркера содержат только его города.
+
+    python router.py --workers 4 --port 8000
+        запускает 4 воркера `uvicorn main:app` на портах 8101..8104 и роутер на 8000
+    python router.py --worker-url http://10.0.0.5:8000 --worker-url http://10.0.0.6:8000
+        маршрутизирует на уже запущенные воркеры
+
+Добавление воркера: POST /router/workers {"url": "..."} (без url - запуск нового локального воркера);
+при этом на новый воркер переезжает только ~1/N городов, и только после того, как его /ready ответит 200
+(не дольше WORKER_READY_TIMEOUT секунд, иначе 503). Удаление: DELETE /router/workers {"url": "..."}.
+"""
+import argparse
+import asyncio
+import bisect
+import hashlib
+import os
+import subprocess
+import sys
+import time
+from typing import Optional
+
+import httpx
+import msgspec
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+from starlette.background import BackgroundTask
+
+VIRTUAL_NODES = 100
+# Сколько ждать /ready нового воркера, прежде чем перевести на него города
+WORKER_READY_TIMEOUT = float(os.getenv("WORKER_READY_TIMEOUT", "60"))
+# Заголовки ответа, которые не передаются клиенту как есть
+HOP_BY_HOP_HEADERS = {"connection", "content-length", "transfer-encoding", "keep-alive"}
+
+
+class HashRing:
+    """Консистентное хэширование с виртуальными узлами."""
+
+    def __init__(self, nodes=(), virtual_nodes=VIRTUAL_NODES):
+        self.virtual_nodes = virtual_nodes
+        self.ring = []  # отсортированные (хэш, узел)
+        for node in nodes:
+            self.add_node(node)
+
+    @staticmethod
+    def hash(value):
+        return int.from_bytes(hashlib.md5(value.encode('utf-8')).digest()[:8], "big")
+
+    @property
+    def nodes(self):
+        return sorted({node for _, node in self.ring})
+
+    def add_node(self, node):
+        if any(existing == node for _, existing in self.ring):
+            return  # Повторное добавление удвоило бы долю узла
+        for i in range(self.virtual_nodes):
+            bisect.insort(self.ring, (self.hash(f"{node}#{i}"), node))
+
+    def remove_node(self, node):
+        self.ring = [point for point in self.ring if point[1] != node]
+
+    def get_node(self, key):
+        if not self.ring:
+            return None
+        index = bisect.bisect_right(self.ring, (self.hash(key), ""))
+        return self.ring[index % len(self.ring)][1]
+
+    def shares(self):
+        """Доля пространства хэшей, закрепленная за каждым узлом."""
+        shares = dict.fromkeys(self.nodes, 0.0)
+        previous = self.ring[-1][0] - 2 ** 64 if self.ring else 0
+        for point, node in self.ring:
+            shares[node] += (point - previous) / 2 ** 64
+            previous = point
+        return shares
+
+
+class CityOnly(msgspec.Struct):
+    city: str = ""
+
+
+city_decoder = msgspec.json.Decoder(CityOnly)
+
+
+class WorkerRequest(msgspec.Struct):
+    url: Optional[str] = None
+
+
+worker_decoder = msgspec.json.Decoder(WorkerRequest)
+
+app = FastAPI()
+ring = HashRing()
+state = {"client": None, "processes": {}, "next_port": 8101, "worker_host": "127.0.0.1"}
+
+
+def spawn_worker():
+    """Запускает локальный воркер main:app со своим файлом статистики прогрева."""
+    port = state["next_port"]
+    state["next_port"] += 1
+    env = {**os.environ, "SHARD_ID": str(port), "WARMUP_KEYS_FILE": f"warmup_keys.{port}.json"}
+    process = subprocess.Popen(
+        [
+            sys.executable, "-m", "uvicorn", "main:app",
+            "--app-dir", os.path.dirname(os.path.abspath(__file__)),
+            "--host", state["worker_host"],
+            "--port", str(port),
+        ],
+        env=env,
+    )
+    url = f"http://{state['worker_host']}:{port}"
+    state["processes"][url] = process
+    return url
+
+
+def forward_headers(request):
+    return {
+        name: value for name, value in request.headers.items()
+        if name.lower() not in HOP_BY_HOP_HEADERS and name.lower() != "host"
+    }
+
+
+async def proxy(request, worker_url, path, body=None, params=None):
+    """Передает запрос воркеру и стримит ответ обратно (в т.ч. NDJSON-режим /best_options)."""
+    upstream_request = state["client"].build_request(
+        request.method,
+        worker_url + path,
+        params=params if params is not None else request.query_params,
+        headers=forward_headers(request),
+        content=body if body is not None else await request.body(),
+    )
+    try:
+        response = await state["client"].send(upstream_request, stream=True)
+    except httpx.RequestError as e:
+        return JSONResponse(content={"error": f"Worker {worker_url} is unavailable: {e}"}, status_code=503)
+
+    headers = {name: value for name, value in response.headers.items() if name.lower() not in HOP_BY_HOP_HEADERS}
+    return StreamingResponse(
+        response.aiter_raw(),
+        status_code=response.status_code,
+        headers=headers,
+        background=BackgroundTask(response.aclose),
+    )
+
+
+@app.on_event("startup")
+async def start_client():
+    state["client"] = httpx.AsyncClient(timeout=None)
+
+
+@app.on_event("shutdown")
+async def stop_workers():
+    await state["client"].aclose()
+    for process in state["processes"].values():
+        process.terminate()
+
+
+@app.post("/best_options")
+async def best_options(request: Request):
+    body = await request.body()
+    try:
+        city = city_decoder.decode(body).city
+    except msgspec.DecodeError:
+        city = ""  # Ошибку разбора вернет воркер
+    return await proxy(request, ring.get_node(city), "/best_options", body)
+
+
+@app.get("/router/workers")
+async def list_workers():
+    return {"workers": ring.shares()}
+
+
+def parse_worker_request(body):
+    """Тело {"url": "..."} ручек /router/workers или JSONResponse с ошибкой 400."""
+    if not body:
+        return WorkerRequest()
+    try:
+        return worker_decoder.decode(body)
+    except msgspec.DecodeError as e:
+        return JSONResponse(content={"error": f"Invalid request body: {e}"}, status_code=400)
+
+
+async def wait_until_ready(url, timeout=WORKER_READY_TIMEOUT):
+    """Ждет, пока воркер начнет отвечать 200 на /ready (запущен и прогрел кэши)."""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            response = await state["client"].get(url + "/ready", timeout=5)
+            if response.status_code == 200:
+                return True
+        except httpx.HTTPError:
+            pass  # Воркер еще не слушает порт
+        await asyncio.sleep(0.5)
+    return False
+
+
+@app.post("/router/workers")
+async def add_worker(request: Request):
+    worker_request = parse_worker_request(await request.body())
+    if isinstance(worker_request, JSONResponse):
+        return worker_request
+
+    url = worker_request.url or spawn_worker()
+    if url not in ring.nodes:
+        # Города переезжают на воркер только после того, как он готов их обслуживать
+        if not await wait_until_ready(url):
+            process = state["processes"].pop(url, None)
+            if process is not None:
+                process.terminate()
+            return JSONResponse(content={"error": f"Worker {url} is not ready"}, status_code=503)
+        ring.add_node(url)  # Не дублируется, если тот же воркер добавили параллельным запросом
+    return {"workers": ring.shares()}
+
+
+@app.delete("/router/workers")
+async def remove_worker(request: Request):
+    worker_request = parse_worker_request(await request.body())
+    if isinstance(worker_request, JSONResponse):
+        return worker_request
+
+    url = worker_request.url
+    if url not in ring.nodes or len(ring.nodes) == 1:
+        return JSONResponse(content={"error": "Unknown or last worker"}, status_code=400)
+    ring.remove_node(url)
+    process = state["processes"].pop(url, None)
+    if process is not None:
+        process.terminate()
+    return {"workers": ring.shares()}
+
+
+async def fetch_from_workers(path):
+    async def fetch(url):
+        try:
+            response = await state["client"].get(url + path, timeout=5)
+            return url, response.status_code, response.json()
+        except (httpx.HTTPError, ValueError) as e:
+            return url, None, {"error": str(e)}
+
+    return await asyncio.gather(*(fetch(url) for url in ring.nodes))
+
+
+@app.get("/ready")
+async def readiness():
+    results = await fetch_from_workers("/ready")
+    ready = all(status == 200 for _, status, _ in results)
+    return JSONResponse(
+        content={"status": "ready" if ready else "warming_up", "workers": {url: body for url, _, body in results}},
+        status_code=200 if ready else 503,
+    )
+
+
+@app.get("/stats")
+async def stats():
+    return {"workers": {url: body for url, _, body in await fetch_from_workers("/stats")}}
+
+
+# Остальные ручки (например, /debug/profile) - на воркер из ?worker=<url> или на первый воркер
+@app.api_route("/{path:path}", methods=["GET", "POST"])
+async def other(request: Request, path: str):
+    worker_url = request.query_params.get("worker") or ring.nodes[0]
+    # Только известные воркеры: иначе роутер стал бы открытым прокси и отправил бы заголовки (X-Profile-Token) наружу
+    if worker_url not in ring.nodes:
+        return JSONResponse(content={"error": f"Unknown worker {worker_url}"}, status_code=400)
+    params = [(name, value) for name, value in request.query_params.multi_items() if name != "worker"]
+    return await proxy(request, worker_url, "/" + path, params=params)
+
+
+def run():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=int(os.getenv("PORT", "8000")))
+    parser.add_argument("--workers", type=int, default=0, help="number of local workers to spawn")
+    parser.add_argument("--worker-port", type=int, default=8101, help="port of the first local worker")
+    parser.add_argument("--worker-url", action="append", default=[], help="already running worker")
+    args = parser.parse_args()
+
+    state["next_port"] = args.worker_port
+    for url in args.worker_url:
+        ring.add_node(url)
+    for _ in range(args.workers):
+        ring.add_node(spawn_worker())
+    if not ring.nodes:
+        parser.error("either --workers or --worker-url is required")
+
+    uvicorn.run(app, host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    run()